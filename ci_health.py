@@ -6,7 +6,7 @@ ci_health.py
 A command-line tool for generating HTML reports from Bamboo MySQL database.
 
 Reporting process:
-1. Query MySQL: `SELECT BUILD_ID, ..., UPDATED_DATE FROM BUILD WHERE BUILD_TYPE IN ('CHAIN_BRANCH', 'CHAIN');`
+1. Query MySQL: `SELECT BUILD_ID, ..., UPDATED_DATE FROM BUILD WHERE BUILD_TYPE IN ('CHAIN_BRANCH', 'CHAIN', 'BUILD');`
 2. Get records like these:
    ```plain
             BUILD_ID: 35095049
@@ -28,24 +28,273 @@ a static file directory on the `<bamboo_host>/static/ci-health/` URL.
 """
 import datetime
 import os
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
 import click
-import sh
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import sqlalchemy as sa
 import xml.etree.ElementTree as ET
-from hurry.filesize import size as hurry_size
 
+from report_io import dump_df, load_df, open_df_writer, render_html_table, write_html_report
+
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+
+# Compact column types for the builds DataFrame, `BUILD_TYPE` has only the few values queried from MySQL
+DB_BUILDS_DTYPES = {
+    'BUILD_ID': 'int64',
+    'BUILD_TYPE': pd.CategoricalDtype(['CHAIN_BRANCH', 'CHAIN', 'BUILD']),
+    'FULL_KEY': 'string',
+    'TITLE': 'string',
+    'DESCRIPTION': 'string',
+    'LINKED_JIRA_ISSUE': 'string',
+    'CREATED_DATE': 'datetime64[ns]',
+    'UPDATED_DATE': 'datetime64[ns]',
+}
+
+# Explicit column types for the builds dump, so that every streamed chunk is written with the same schema
+DB_BUILDS_SCHEMA = pa.schema([
+    ('BUILD_ID', pa.int64()),
+    ('BUILD_TYPE', pa.dictionary(pa.int8(), pa.string())),
+    ('FULL_KEY', pa.string()),
+    ('TITLE', pa.string()),
+    ('DESCRIPTION', pa.string()),
+    ('LINKED_JIRA_ISSUE', pa.string()),
+    ('CREATED_DATE', pa.timestamp('ns')),
+    ('UPDATED_DATE', pa.timestamp('ns')),
+])
+
+
+def _get_dir_disk_usage(dir_path: str) -> int:
+    """Get the disk usage (in bytes, as counted by `du -s`) of a directory tree, walked with `os.scandir`.
+
+    Like `du`, a file hard-linked several times within the tree is only counted once.
+    """
+    disk_usage = os.stat(dir_path, follow_symlinks=False).st_blocks * 512
+    seen_inodes = set()
+    dirs_to_walk = [dir_path]
+    while dirs_to_walk:
+        with os.scandir(dirs_to_walk.pop()) as entries:
+            for entry in entries:
+                entry_stat = entry.stat(follow_symlinks=False)
+                if entry_stat.st_nlink > 1 and not entry.is_dir(follow_symlinks=False):
+                    inode = (entry_stat.st_dev, entry_stat.st_ino)
+                    if inode in seen_inodes:
+                        continue
+                    seen_inodes.add(inode)
+                disk_usage += entry_stat.st_blocks * 512
+                if entry.is_dir(follow_symlinks=False):
+                    dirs_to_walk.append(entry.path)
+    return disk_usage
+
+
+def _get_dir_disk_usages(dir_paths: list) -> list:
+    """Get the disk usages (in bytes) of directory trees, walked concurrently with `_get_dir_disk_usage`."""
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        return list(executor.map(_get_dir_disk_usage, dir_paths))
+
+
+def _format_sizes(sizes: pd.Series) -> pd.Series:
+    """Format sizes in bytes as human-readable strings, e.g. `15M` (same format as `hurry.filesize.size`)."""
+    unit_sizes = 1024 ** np.arange(6)
+    units = np.clip(np.searchsorted(unit_sizes, sizes.to_numpy(), side='right') - 1, 0, None)
+    amounts = sizes.to_numpy() // unit_sizes[units]
+    suffixes = np.array(['B', 'K', 'M', 'G', 'T', 'P'], dtype=object)
+    return pd.Series(amounts.astype(str), index=sizes.index, dtype=object) + suffixes[units]
+
+
+def _require_dump(tmp_dir: str, dump_file: str, description: str, sub_command: str) -> str:
+    """Get the path to a DataFrame dump in `--tmp-dir`, exit if the sub-command that creates it hasn't been run."""
+    dump_path = f"{tmp_dir}/{dump_file}"
+    if not os.path.isfile(dump_path):
+        click.echo(f"{description} not found at {dump_path}, did you run `./ci_health.py {sub_command}`?")
+        exit(1)
+    return dump_path
 
-def _get_build_artifact_size(row: pd.Series, debug=False) -> pd.Series:
-    """Get the size of the artifact directory for a build ID in `--bamboo-home`."""
-    artifact_dir = row['FS_ARTIFACT_DIR']
-    artifact_size = int(sh.du("-s", artifact_dir).split()[0])
-    if debug:
-        click.echo(f"Artifact size for build plan '{artifact_dir}' is {artifact_size} kilobytes...")
-    row['FS_ARTIFACT_SIZE'] = artifact_size * 1024
-    row['FS_ARTIFACT_DATE'] = datetime.datetime.utcnow().replace(microsecond=0)
-    return row
+
+def _get_db_credentials_from_bamboo_cfg(bamboo_home: str, debug: False) -> [str, str, str]:
+    """Get the username, password and hostname for the Bamboo database from `{--bamboo-home}/bamboo.cfg.xml`."""
+    bamboo_cfg = f"{bamboo_home}/bamboo.cfg.xml"
+    if not os.path.isfile(bamboo_cfg):
+        click.echo(
+            f"Bamboo config file '{bamboo_cfg}' not found, did you specify the correct `./ci_health --bamboo-home`?"
+        )
+        exit(1)
+    try:
+        tree = ET.parse(bamboo_cfg)
+        root = tree.getroot()
+        app_config = root.find('properties')
+        db_host, db_user, db_passwd = None, None, None
+        for config_property in app_config.findall('./property'):
+            if config_property.get('name') == 'hibernate.connection.url':
+                db_host = config_property.text.split("jdbc:mysql://")[1].split("/bamboo")[0]
+                if debug:
+                    click.echo(f"Found database host in {config_property.get('name')}: {db_host}")
+            if config_property.get('name') == 'hibernate.connection.username':
+                db_user = config_property.text
+                if debug:
+                    click.echo(f"Found database user in {config_property.get('name')}: {db_user}")
+            if config_property.get('name') == 'hibernate.connection.password':
+                db_passwd = config_property.text
+                if debug:
+                    click.echo(f"Found database password in {config_property.get('name')}: {'*' * len(db_passwd)}")
+        if all([db_host, db_user, db_passwd]):
+            return db_host, db_user, db_passwd
+        else:
+            click.echo(f"Database credentials not fully identified in Bamboo config file '{bamboo_cfg}'")
+            exit(1)
+    except Exception as e:
+        click.echo(f"Error parsing Bamboo config file '{bamboo_cfg}': {e}")
+        exit(1)
+
+
+def _query_mysql_for_builds(db_host: str, db_user: str, db_passwd: str, limit_: int = None,
+                            chunksize: int = 50_000) -> Iterator[pd.DataFrame]:
+    """Query MySQL database for 'CHAIN_BRANCH', 'CHAIN' and 'BUILD' type builds, streamed in chunks of rows.
+
+    Uses ConnectorX to read all rows at once if it's installed, otherwise falls back to pandas/PyMySQL.
+    """
+    query = f"""
+        SELECT
+            BUILD_ID, BUILD_TYPE, FULL_KEY, TITLE, DESCRIPTION, LINKED_JIRA_ISSUE, CREATED_DATE, UPDATED_DATE
+        FROM
+            build
+        WHERE
+            BUILD_TYPE IN ('CHAIN_BRANCH', 'CHAIN', 'BUILD')
+        {'LIMIT ' + str(limit_) if limit_ else ''}
+    """
+    if cx is not None:
+        # ConnectorX fills the DataFrame columns natively, in parallel partitions unless the rows are limited
+        partitioning = {} if limit_ else {'partition_on': 'BUILD_ID', 'partition_num': 4}
+        yield cx.read_sql(f"mysql://{db_user}:{db_passwd}@{db_host}/bamboo", query, return_type='pandas',
+                          **partitioning)
+        return
+    engine = sa.create_engine(f"mysql+pymysql://{db_user}:{db_passwd}@{db_host}/bamboo")
+    try:
+        with engine.connect() as conn:
+            # Server-side cursor, so that only one chunk of rows is held in memory at a time
+            streaming_conn = conn.execution_options(stream_results=True)
+            yield from pd.read_sql(query, streaming_conn, chunksize=chunksize)
+    finally:
+        engine.dispose()
+
+
+def _phase_db(ctx: any, limit: int = None) -> Iterator[pd.DataFrame]:
+    """Get the Bamboo builds from MySQL, as chunks of rows with the `DB_BUILDS_DTYPES` column types.
+
+    The database credentials are read from `bamboo.cfg.xml` right away, only the query is deferred to the iteration.
+    """
+    db_credentials = _get_db_credentials_from_bamboo_cfg(ctx.obj['BAMBOO_HOME'], ctx.obj['DEBUG'])
+
+    def _iter_chunks() -> Iterator[pd.DataFrame]:
+        for df in _query_mysql_for_builds(*db_credentials, limit_=limit):
+            if ctx.obj['DEBUG']:
+                click.echo(f"Database builds DataFrame chunk of {len(df)} rows:")
+                click.echo(df)
+            # Use compact column types, rather than falling back to object columns
+            yield df.astype(DB_BUILDS_DTYPES)
+
+    return _iter_chunks()
+
+
+def _phase_fs(ctx: any, df: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
+    """Get the builds with artifact directories and their sizes, and the listing of all artifact directories."""
+    # List the artifact directories once, and keep the listing for finding the orphans
+    artifacts_root = f"{ctx.obj['BAMBOO_HOME']}/shared/artifacts"
+    with os.scandir(artifacts_root) as entries:
+        existing_dirs = {entry.name for entry in entries if entry.is_dir(follow_symlinks=False)}
+    if ctx.obj['DEBUG']:
+        click.echo(f"Found {len(existing_dirs)} directories in '{artifacts_root}'...")
+    df_dirs = pd.DataFrame(sorted(f"{artifacts_root}/{name}" for name in existing_dirs), columns=['FS_ARTIFACT_DIR'])
+    # Add a separate column to the DataFrame with the artifact directory (if it exists)
+    plan_dirs = 'plan-' + df['BUILD_ID'].astype(str)
+    df = df.assign(FS_ARTIFACT_DIR=(f"{artifacts_root}/" + plan_dirs).where(plan_dirs.isin(existing_dirs)))
+    df_with_artifact_dirs = df[df['FS_ARTIFACT_DIR'].notna()]
+    if ctx.obj['DEBUG']:
+        click.echo('Builds with artifact directories DataFrame:')
+        click.echo(df_with_artifact_dirs)
+    # Add two separate columns to the DataFrame with the size of the artifact directory and the date of the size check
+    checked_date = pd.Timestamp(datetime.datetime.utcnow().replace(microsecond=0))
+    artifact_dirs = df_with_artifact_dirs['FS_ARTIFACT_DIR'].tolist()
+    artifact_sizes = _get_dir_disk_usages(artifact_dirs)
+    if ctx.obj['DEBUG']:
+        for artifact_dir, artifact_size in zip(artifact_dirs, artifact_sizes):
+            click.echo(f"Artifact size for build plan '{artifact_dir}' is {artifact_size // 1024} kilobytes...")
+    df_with_artifact_sizes = df_with_artifact_dirs.assign(
+        FS_ARTIFACT_SIZE=pd.Series(artifact_sizes, index=df_with_artifact_dirs.index, dtype='int64'),
+        FS_ARTIFACT_DATE=checked_date,
+    )
+    if ctx.obj['DEBUG']:
+        click.echo(f"Filesystem builds DataFrame:")
+        click.echo(df_with_artifact_sizes)
+    return df_with_artifact_sizes, df_dirs
+
+
+def _phase_orphans(ctx: any, df_fs: pd.DataFrame, df_dirs: pd.DataFrame) -> pd.DataFrame:
+    """Get the artifact directories that don't belong to any known build, and their sizes."""
+    all_dirs = df_dirs['FS_ARTIFACT_DIR']
+    is_special_dir = all_dirs.str.rsplit('/', n=1).str[-1].isin({'tmp', 'globalStorage'})
+    for dir_path in all_dirs[is_special_dir]:
+        click.echo(f"Ignore special sub-directory '{dir_path}'...")
+    known_dirs = set(df_fs['FS_ARTIFACT_DIR'].tolist())
+    orphaned_dirs = all_dirs[~is_special_dir & ~all_dirs.isin(known_dirs)].tolist()
+    if ctx.obj['DEBUG']:
+        for dir_path in orphaned_dirs:
+            click.echo(f"Found orphaned directory: {os.path.basename(dir_path)}")
+    click.echo(f"Found {len(orphaned_dirs)} orphaned directories, from a total {len(df_fs)} known artifact build dirs.")
+    checked_date = pd.Timestamp(datetime.datetime.utcnow().replace(microsecond=0))
+    # Walk the orphaned directory trees concurrently instead of running `du` on them
+    orphans_sizes = _get_dir_disk_usages(orphaned_dirs)
+    if ctx.obj['DEBUG']:
+        for dir_path, orphan_size in zip(orphaned_dirs, orphans_sizes):
+            click.echo(f"Artifact size for orphaned directory '{dir_path}' is {orphan_size // 1024} kilobytes...")
+    orphans_df = pd.DataFrame({
+        'FS_ARTIFACT_DIR': pd.Series(orphaned_dirs, dtype='object'),
+        'FS_ARTIFACT_SIZE': pd.Series(orphans_sizes, dtype='int64'),
+        'FS_ARTIFACT_DATE': checked_date,
+    })
+    if ctx.obj['DEBUG']:
+        click.echo(f"Filesystem orphans DataFrame:")
+        click.echo(orphans_df)
+    return orphans_df
+
+
+def _phase_reports(ctx: any, df_fs: pd.DataFrame, output_dir: str) -> None:
+    """Write the HTML and Parquet reports of build plans by shared artifact size to `--output-dir`."""
+    # Prepare output directories
+    reports_archive_dir = f"{output_dir}/archive"
+    os.makedirs(reports_archive_dir, mode=0o775, exist_ok=True)
+    if ctx.obj['DEBUG']:
+        click.echo(f"Writing reports to `--output-dir` '{output_dir}' (archive dir '{reports_archive_dir}')...")
+
+    # Build the report columns for plans with shared artifact sizes > 1MB, sorted by artifact size, in one pass
+    df_columns_for_report = (
+        df_fs.loc[df_fs['FS_ARTIFACT_SIZE'] > 1024**2]
+        .sort_values(by='FS_ARTIFACT_SIZE', ascending=False)
+        .assign(
+            TYPE=lambda df: df['BUILD_TYPE'].str.rsplit('_', n=1).str[-1],
+            PLAN_LINK=lambda df: '<a href="/browse/' + df['FULL_KEY'] + '" target="_blank">' + df['FULL_KEY'] + '</a>',
+            CHECKED_DATE=lambda df: df['FS_ARTIFACT_DATE'],
+            DISK_SIZE=lambda df: _format_sizes(df['FS_ARTIFACT_SIZE']),
+        )
+        .loc[:, ['TYPE', 'TITLE', 'PLAN_LINK', 'CREATED_DATE', 'UPDATED_DATE', 'CHECKED_DATE', 'DISK_SIZE']]
+    )
+    if ctx.obj['DEBUG']:
+        click.echo(f"Builds DataFrame columns for report:")
+        click.echo(df_columns_for_report)
+
+    # Write the report to HTML and Parquet files
+    archive_date = datetime.datetime.utcnow()
+    archive_file = f"{reports_archive_dir}/{archive_date.strftime('%y%m%dT%HZ')}_plans_by_shared_artifact_size_desc"
+    click.echo(f"Writing report to '{output_dir}/index.html', '{archive_file}.html[.gz]', and "
+               f"'{archive_file}.parquet'")
+    df_columns_for_report.to_parquet(f"{archive_file}.parquet", engine='pyarrow', compression='snappy')
+    write_html_report(render_html_table(df_columns_for_report), f"{archive_file}.html", f"{output_dir}/index.html")
 
 
 @click.group()
@@ -66,6 +315,11 @@ def cli(ctx: any, debug: bool, tmp_dir: str, bamboo_home: str, max_content_width
     2. ./ci_health.py --tmp-dir=/tmp/ci-health --bamboo-home=/opt/bamboo-master-home 1b-init-fs-artifacts
     3. ./ci_health.py --tmp-dir=/tmp/ci-health --bamboo-home=/opt/bamboo-master-home 1c-find-orphans
     4. ./ci_health.py --tmp-dir=/tmp/ci-health --bamboo-home=/opt/bamboo-master-home 2-generate-reports --output-dir=/usr/share/nginx/html/static/ci-health
+
+    Or run the whole sequence in one process, without the intermediate dumps in temp dir (except the orphans):
+
+    \b
+    ./ci_health.py --tmp-dir=/tmp/ci-health --bamboo-home=/opt/bamboo-master-home all --output-dir=/usr/share/nginx/html/static/ci-health
     """
     os.makedirs(tmp_dir, exist_ok=True)
     if debug:
@@ -83,63 +337,23 @@ def cli(ctx: any, debug: bool, tmp_dir: str, bamboo_home: str, max_content_width
 @click.pass_context
 def init_db_builds(ctx, limit: int, max_content_width=120):
     """Initialize Bamboo builds data from MySQL, stored to `--tmp-dir`."""
-
-    def _get_db_credentials_from_bamboo_cfg(bamboo_home: str, debug: False) -> [str, str, str]:
-        """Get the username, password and hostname for the Bamboo database from `{--bamboo-home}/bamboo.cfg.xml`."""
-        bamboo_cfg = f"{bamboo_home}/bamboo.cfg.xml"
-        if not os.path.isfile(bamboo_cfg):
-            click.echo(
-                f"Bamboo config file '{bamboo_cfg}' not found, did you specify the correct `./ci_health --bamboo-home`?"
-            )
-            exit(1)
-        try:
-            tree = ET.parse(bamboo_cfg)
-            root = tree.getroot()
-            app_config = root.find('properties')
-            db_host, db_user, db_passwd = None, None, None
-            for config_property in app_config.findall('./property'):
-                if config_property.get('name') == 'hibernate.connection.url':
-                    db_host = config_property.text.split("jdbc:mysql://")[1].split("/bamboo")[0]
-                    if debug:
-                        click.echo(f"Found database host in {config_property.get('name')}: {db_host}")
-                if config_property.get('name') == 'hibernate.connection.username':
-                    db_user = config_property.text
-                    if debug:
-                        click.echo(f"Found database user in {config_property.get('name')}: {db_user}")
-                if config_property.get('name') == 'hibernate.connection.password':
-                    db_passwd = config_property.text
-                    if debug:
-                        click.echo(f"Found database password in {config_property.get('name')}: {'*' * len(db_passwd)}")
-            if all([db_host, db_user, db_passwd]):
-                return db_host, db_user, db_passwd
-            else:
-                click.echo(f"Database credentials not fully identified in Bamboo config file '{bamboo_cfg}'")
-                exit(1)
-        except Exception as e:
-            click.echo(f"Error parsing Bamboo config file '{bamboo_cfg}': {e}")
-            exit(1)
-
-    def _query_mysql_for_builds(db_host: str, db_user: str, db_passwd: str, limit_: int = None) -> pd.DataFrame:
-        """Query MySQL database for 'CHAIN_BRANCH' and 'CHAIN' type builds."""
-        query = f"""
-            SELECT
-                BUILD_ID, BUILD_TYPE, FULL_KEY, TITLE, DESCRIPTION, LINKED_JIRA_ISSUE, CREATED_DATE, UPDATED_DATE
-            FROM
-                build
-            -- WHERE
-            --     BUILD_TYPE IN ('CHAIN_BRANCH', 'CHAIN', 'BUILD')
-            {'LIMIT ' + str(limit_) if limit_ else ''}
-        """
-        return pd.read_sql(query, f"mysql+pymysql://{db_user}:{db_passwd}@{db_host}/bamboo")
-
-    df = _query_mysql_for_builds(*_get_db_credentials_from_bamboo_cfg(ctx.obj['BAMBOO_HOME'], ctx.obj['DEBUG']),
-                                 limit_=limit)
-    if ctx.obj['DEBUG']:
-        click.echo(f"Database builds DataFrame:")
-        click.echo(df)
-    dump_path = f"{ctx.obj['TMP_DIR']}/db_bamboo_builds_t0.pkl"
-    df.to_pickle(dump_path)
-    click.echo(f"Database builds DataFrame dumped to {dump_path}")
+    dump_path = f"{ctx.obj['TMP_DIR']}/db_bamboo_builds_t0.arrow"
+    # Stream the chunks to a temp file and only replace the dump once all rows are read, so that a failing query
+    # doesn't leave an empty or truncated dump behind for `1b-init-fs-artifacts`
+    tmp_dump_path = f"{dump_path}.tmp"
+    db_chunks = _phase_db(ctx, limit)
+    num_rows = 0
+    try:
+        with open_df_writer(tmp_dump_path, DB_BUILDS_SCHEMA) as writer:
+            for df in db_chunks:
+                writer.write_table(pa.Table.from_pandas(df, schema=DB_BUILDS_SCHEMA, preserve_index=False))
+                num_rows += len(df)
+    except BaseException:
+        if os.path.exists(tmp_dump_path):
+            os.remove(tmp_dump_path)
+        raise
+    os.replace(tmp_dump_path, dump_path)
+    click.echo(f"Database builds DataFrame ({num_rows} rows) dumped to {dump_path}")
 
 
 @cli.command('1b-init-fs-artifacts')
@@ -147,74 +361,33 @@ def init_db_builds(ctx, limit: int, max_content_width=120):
 def init_fs_artifacts(ctx):
     """Initialize Bamboo build artifact sizes from filesystem, stored to `--tmp-dir`."""
 
-    def _get_build_artifact_dir(build_id: int, bamboo_home: str, debug=False) -> Union[str, any]:
-        """Get the artifact directory for a build ID in `--bamboo-home`."""
-        artifact_dir = f"{bamboo_home}/shared/artifacts/plan-{build_id}"
-        if os.path.isdir(artifact_dir):
-            if debug:
-                click.echo(f"Artifact directory found: '{artifact_dir}'...")
-            return artifact_dir
-        else:
-            return pd.NA
-
-    dump_path_db = f"{ctx.obj['TMP_DIR']}/db_bamboo_builds_t0.pkl"
-    if not os.path.isfile(dump_path_db):
-        click.echo(
-            f"Database builds DataFrame not found at {dump_path_db}, did you run `./ci_health.py init-db-builds`?"
-        )
-        exit(1)
-    df = pd.read_pickle(dump_path_db)
+    dump_path_db = _require_dump(ctx.obj['TMP_DIR'], 'db_bamboo_builds_t0.arrow', "Database builds DataFrame",
+                                 '1a-init-db-builds')
+    df = load_df(dump_path_db).astype(DB_BUILDS_DTYPES)
     if ctx.obj['DEBUG']:
         click.echo(f"Database builds DataFrame read from {dump_path_db}:")
         click.echo(df)
-    # Add a separate column to the DataFrame with the artifact directory (if it exists)
-    df['FS_ARTIFACT_DIR'] = df['BUILD_ID'].apply(_get_build_artifact_dir,
-                                                 args=[ctx.obj['BAMBOO_HOME'], ctx.obj['DEBUG']])
-    df_with_artifact_dirs = df[df['FS_ARTIFACT_DIR'].notna()]
-    if ctx.obj['DEBUG']:
-        click.echo('Builds with artifact directories DataFrame:')
-        click.echo(df_with_artifact_dirs)
-    # Add two separate columns to the DataFrame with the size of the artifact directory and the date of the size check
-    df_with_artifact_sizes = df_with_artifact_dirs.apply(_get_build_artifact_size, args=[ctx.obj['DEBUG']], axis=1)
-    dump_path_fs = f"{ctx.obj['TMP_DIR']}/fs_bamboo_builds_t0.pkl"
-    df_with_artifact_sizes.to_pickle(dump_path_fs)
-    if ctx.obj['DEBUG']:
-        click.echo(f"Filesystem builds DataFrame:")
-        click.echo(df_with_artifact_sizes)
+    df_with_artifact_sizes, df_dirs = _phase_fs(ctx, df)
+    dump_path_dirs = f"{ctx.obj['TMP_DIR']}/fs_bamboo_artifact_dirs_t0.arrow"
+    dump_df(df_dirs, dump_path_dirs)
+    dump_path_fs = f"{ctx.obj['TMP_DIR']}/fs_bamboo_builds_t0.arrow"
+    dump_df(df_with_artifact_sizes, dump_path_fs)
     # Done with the filesystem builds DataFrame
-    click.echo(f"Filesystem builds DataFrame dumped to {dump_path_fs}")
+    click.echo(f"Filesystem builds DataFrame dumped to {dump_path_fs} (artifact dirs listed in {dump_path_dirs})")
 
 
 @cli.command('1c-find-orphans')
 @click.pass_context
 def find_orphans(ctx):
     """Find orphaned artifact directories in the $BAMBOO_HOME/shared/artifacts/ directory."""
-    dump_path_fs = f"{ctx.obj['TMP_DIR']}/fs_bamboo_builds_t0.pkl"
-    if not os.path.isfile(dump_path_fs):
-        click.echo(
-            f"Filesystem builds DataFrame not found at {dump_path_fs}, did you run `./ci_health.py init-fs-artifacts`?"
-        )
-        exit(1)
-
-    df_fs = pd.read_pickle(dump_path_fs)
-    orphaned_dirs = []
-    for build_dir in os.scandir(f"{ctx.obj['BAMBOO_HOME']}/shared/artifacts"):
-        dir_path = f"{ctx.obj['BAMBOO_HOME']}/shared/artifacts/{build_dir.name}"
-        if build_dir.name in {'tmp', 'globalStorage'}:
-            click.echo(f"Ignore special sub-directory '{dir_path}'...")
-            continue
-        if dir_path not in list(df_fs['FS_ARTIFACT_DIR']):
-            orphaned_dirs.append(dir_path)
-            if ctx.obj['DEBUG']:
-                click.echo(f"Found orphaned directory: {build_dir.name}")
-    click.echo(f"Found {len(orphaned_dirs)} orphaned directories, from a total {len(df_fs)} known artifact build dirs.")
-    orphans_df = pd.DataFrame(orphaned_dirs, columns=['FS_ARTIFACT_DIR'])
-    orphans_df_with_artifact_sizes = orphans_df.apply(_get_build_artifact_size, args=(ctx.obj['DEBUG'],), axis=1)
-    dump_path_orphans = f"{ctx.obj['TMP_DIR']}/fs_bamboo_orphans_t0.pkl"
-    orphans_df_with_artifact_sizes.to_pickle(dump_path_orphans)
-    if ctx.obj['DEBUG']:
-        click.echo(f"Filesystem orphans DataFrame:")
-        click.echo(orphans_df_with_artifact_sizes)
+    dump_path_fs = _require_dump(ctx.obj['TMP_DIR'], 'fs_bamboo_builds_t0.arrow', "Filesystem builds DataFrame",
+                                 '1b-init-fs-artifacts')
+    dump_path_dirs = _require_dump(ctx.obj['TMP_DIR'], 'fs_bamboo_artifact_dirs_t0.arrow', "Artifact dirs listing",
+                                   '1b-init-fs-artifacts')
+
+    orphans_df = _phase_orphans(ctx, load_df(dump_path_fs), load_df(dump_path_dirs))
+    dump_path_orphans = f"{ctx.obj['TMP_DIR']}/fs_bamboo_orphans_t0.arrow"
+    dump_df(orphans_df, dump_path_orphans)
     # Done with the orphans builds DataFrame
     click.echo(f"Filesystem orphans DataFrame dumped to {dump_path_orphans}")
 
@@ -225,63 +398,31 @@ def find_orphans(ctx):
 @click.pass_context
 def generate_reports(ctx, output_dir: str):
     """Generate HTML reports from Bamboo builds data and artifact directory sizes."""
-    dump_path_db = f"{ctx.obj['TMP_DIR']}/db_bamboo_builds_t0.pkl"
-    if not os.path.isfile(dump_path_db):
-        click.echo(
-            f"Database builds DataFrame not found at {dump_path_db}, did you run `./ci_health.py init-db-builds`?"
-        )
-        exit(1)
-    dump_path_fs = f"{ctx.obj['TMP_DIR']}/fs_bamboo_builds_t0.pkl"
-    if not os.path.isfile(dump_path_fs):
-        click.echo(
-            f"Filesystem builds DataFrame not found at {dump_path_fs}, did you run `./ci_health.py init-fs-artifacts`?"
-        )
-        exit(1)
+    _require_dump(ctx.obj['TMP_DIR'], 'db_bamboo_builds_t0.arrow', "Database builds DataFrame", '1a-init-db-builds')
+    dump_path_fs = _require_dump(ctx.obj['TMP_DIR'], 'fs_bamboo_builds_t0.arrow', "Filesystem builds DataFrame",
+                                 '1b-init-fs-artifacts')
 
-    # Prepare output directories
-    reports_archive_dir = f"{output_dir}/archive"
-    os.makedirs(reports_archive_dir, mode=0o775, exist_ok=True)
-    if ctx.obj['DEBUG']:
-        click.echo(f"Writing reports to `--output-dir` '{output_dir}' (archive dir '{reports_archive_dir}')`:")
-        click.echo(sh.ls('-lFah', output_dir, reports_archive_dir))
+    _phase_reports(ctx, load_df(dump_path_fs), output_dir)
 
-    # Read raw report data
-    df_fs = pd.read_pickle(dump_path_fs)
 
-    df_with_artifact_gt1mb = df_fs[df_fs['FS_ARTIFACT_SIZE'] > 1024**2]
-    # if ctx.obj['DEBUG']:
-    #     click.echo(f"Builds DataFrame with shared artifact sizes > 1MB:")
-    #     click.echo(df_with_artifact_gt1mb)
+@cli.command('all')
+@click.option('--limit', default=None, type=int)
+@click.option('--output-dir', default=f'/usr/share/nginx/html/static/ci-health',
+              type=click.Path(file_okay=False, resolve_path=True))
+@click.pass_context
+def run_all(ctx, limit: int, output_dir: str):
+    """Run all the sub-commands in sequence, keeping the DataFrames in memory between them.
 
-    df_with_clickable_links = df_with_artifact_gt1mb.copy()
-    df_with_clickable_links['PLAN_LINK'] = df_with_clickable_links['FULL_KEY'].apply(
-        lambda full_key: f'<a href="/browse/{full_key}" target="_blank">{full_key}</a>'
-    )
-    # if ctx.obj['DEBUG']:
-    #     click.echo(f"Builds DataFrame with clickable links:")
-    #     click.echo(df_with_clickable_links)
-
-    df_sorted_by_size = df_with_clickable_links.sort_values(by='FS_ARTIFACT_SIZE', ascending=False)
-    df_sorted_by_size['DISK_SIZE'] = df_sorted_by_size['FS_ARTIFACT_SIZE'].apply(hurry_size)
-    # if ctx.obj['DEBUG']:
-    #     click.echo(f"Builds DataFrame sorted by artifact size:")
-    #     click.echo(df_sorted_by_size)
-
-    # Update DataFrame with columns for report and write to HTML and pickle files
-    df_sorted_by_size['CHECKED_DATE'] = df_sorted_by_size['FS_ARTIFACT_DATE']
-    df_sorted_by_size['TYPE'] = df_sorted_by_size['BUILD_TYPE'].apply(lambda type_: type_.split('_')[-1])
-    df_columns_for_report = df_sorted_by_size[
-        ['TYPE', 'TITLE', 'PLAN_LINK', 'CREATED_DATE', 'UPDATED_DATE', 'CHECKED_DATE', 'DISK_SIZE']
-    ]
-    if ctx.obj['DEBUG']:
-        click.echo(f"Builds DataFrame columns for report:")
-        click.echo(df_columns_for_report)
-    archive_date = datetime.datetime.utcnow()
-    archive_file = f"{reports_archive_dir}/{archive_date.strftime('%y%m%dT%HZ')}_plans_by_shared_artifact_size_desc"
-    click.echo(f"Writing report to '{output_dir}/index.html', '{archive_file}.html', and '{archive_file}.pkl'")
-    df_columns_for_report.to_html(f"{archive_file}.html", escape=False, index=False)
-    df_columns_for_report.to_pickle(f"{archive_file}.pkl")
-    df_columns_for_report.to_html(f"{output_dir}/index.html", escape=False, index=False)
+    The orphans DataFrame is still dumped to `--tmp-dir`, like `1c-find-orphans` does.
+    """
+    df = pd.concat(list(_phase_db(ctx, limit)), ignore_index=True)
+    click.echo(f"Database builds DataFrame ({len(df)} rows) queried")
+    df_with_artifact_sizes, df_dirs = _phase_fs(ctx, df)
+    orphans_df = _phase_orphans(ctx, df_with_artifact_sizes, df_dirs)
+    dump_path_orphans = f"{ctx.obj['TMP_DIR']}/fs_bamboo_orphans_t0.arrow"
+    dump_df(orphans_df, dump_path_orphans)
+    click.echo(f"Filesystem orphans DataFrame dumped to {dump_path_orphans}")
+    _phase_reports(ctx, df_with_artifact_sizes, output_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+"""
+report_io.py
+============
+
+Shared helpers for passing DataFrames between the sub-commands of `ci_health.py` and `root_poisoning.py`, and for
+rendering and publishing their HTML reports.
+
+The intermediate DataFrames in `--tmp-dir` are dumped as uncompressed Feather v2 (i.e. the Arrow IPC file format) and
+read back memory-mapped, so that the Arrow buffers are used straight from the page cache without being read into memory
+or decompressed first. Converting them to a pandas DataFrame still costs a copy of the columns, and a conversion to
+Python objects for string columns.
+"""
+import gzip
+import os
+import pathlib
+
+import jinja2
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+# Same table markup as `DataFrame.to_html(escape=False, index=False)`, cells may contain HTML links and tags
+HTML_TABLE_TEMPLATE = jinja2.Template("""\
+<table border="1" class="dataframe">
+  <thead>
+    <tr style="text-align: right;">
+{%- for header in headers %}
+      <th>{{ header }}</th>
+{%- endfor %}
+    </tr>
+  </thead>
+  <tbody>
+{%- for row in rows %}
+    <tr>
+{%- for cell in row %}
+      <td>{{ cell }}</td>
+{%- endfor %}
+    </tr>
+{%- endfor %}
+  </tbody>
+</table>
+""", autoescape=False)
+
+
+def dump_df(df: pd.DataFrame, path: str) -> None:
+    """Dump a DataFrame to an Arrow IPC (Feather v2) file, uncompressed (`write_feather` defaults to LZ4)."""
+    feather.write_feather(df, path, compression='uncompressed')
+
+
+def open_df_writer(path: str, schema: pa.Schema) -> pa.ipc.RecordBatchFileWriter:
+    """Open an Arrow IPC (Feather v2) file for writing a DataFrame in chunks, e.g. `writer.write_table(table)`."""
+    return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=None))
+
+
+def load_df(path: str) -> pd.DataFrame:
+    """Load a DataFrame from an Arrow IPC (Feather v2) file, memory-mapped."""
+    return feather.read_feather(path, memory_map=True)
+
+
+def render_html_table(df: pd.DataFrame) -> str:
+    """Render a DataFrame as an HTML table, without its index and without escaping the cells.
+
+    Missing values (e.g. `pd.NA` in a `string` column) are rendered as empty cells, rather than as a bogus `<NA>` tag.
+    """
+    cells = df.astype(object).where(df.notna(), '')
+    return HTML_TABLE_TEMPLATE.render(headers=list(df.columns), rows=cells.itertuples(index=False, name=None))
+
+
+def write_html_report(html_report: str, archive_path: str, index_path: str) -> None:
+    """Write an HTML report to its archive file and replace the index file with it.
+
+    The archive file gets a pre-gzipped copy for Nginx `gzip_static`, and the index file is replaced atomically, so
+    that Nginx never serves a half-written index.
+    """
+    pathlib.Path(archive_path).write_text(html_report, encoding='utf-8')
+    with gzip.open(f"{archive_path}.gz", 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write(html_report)
+    tmp_index_path = f"{index_path}.tmp"
+    pathlib.Path(tmp_index_path).write_text(html_report, encoding='utf-8')
+    os.replace(tmp_index_path, index_path)
@@ -48,19 +48,83 @@ To expose the generated reports to outside viewers, update the Nginx config to s
 as a static file directory on the `<bamboo_host>/static/ci-health/` URL.
 """
 import datetime
+import functools
+import glob
+import itertools
+import mmap
 import os
-import sys
+import re
+import shutil
+import stat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import click
 import sh
 import pandas as pd
 
+from report_io import dump_df, load_df, render_html_table, write_html_report
 
+
+# Matches the (optionally quoted) file path in `chown -v` output lines, on the raw bytes of a log file
+CHOWNED_FILEPATH_PATTERN = re.compile(
+    "changed ownership of (?:'|‘|’)?(.*?)(?:'|‘|’)? from root:root to bamboo:bamboo".encode('utf-8')
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(dir_path: str) -> str:
+    """Create a directory if needed, at most once per process."""
+    os.makedirs(dir_path, exist_ok=True)
+    return dir_path
+
+
+@functools.lru_cache(maxsize=None)
 def _get_todays_temp_dir(tmp_dir: str, todays_date: str) -> str:
     """Get the temp directory for today's date (create if needed)."""
-    todays_temp_dir = f"{tmp_dir}/{todays_date}_root-poisoning"
-    os.makedirs(todays_temp_dir, exist_ok=True)
-    return todays_temp_dir
+    return _ensure_dir(f"{tmp_dir}/{todays_date}_root-poisoning")
+
+
+def _parse_log_file(log_file_path: str, debug=False) -> pd.DataFrame:
+    """Parse a log file and return a DataFrame with the data in separate columns."""
+    hostname_short = log_file_path.split('/')[-1].split('_')[1].split('.smithmicro.net')[0]
+    with open(log_file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            matched_filepaths = []  # Can't mmap an empty file
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log_file_contents:
+                matched_filepaths = [match.group(1).decode()
+                                     for match in CHOWNED_FILEPATH_PATTERN.finditer(log_file_contents)]
+    filepaths = pd.Series(matched_filepaths, dtype='object')
+    is_build_plan_file = filepaths.str.startswith("/home/bamboo/bamboo-agent-home/xml-data/")
+    for filepath in filepaths[~is_build_plan_file]:
+        click.echo(f"WARN: Ignored non-build plan file '{filepath}' on {hostname_short}!")
+    rel_filepaths = filepaths[is_build_plan_file].str.slice(len('/home/bamboo/bamboo-agent-home/'))
+    # Keep the parts as strings even when no paths matched, the all-NaN columns would be float64 otherwise
+    rel_filepath_parts = rel_filepaths.str.split('/', n=3, expand=True).reindex(columns=range(4)).astype(object)
+    # Skip the job/deployment key directories themselves (and their parents), they have no workspace-local path
+    rel_filepath_parts = rel_filepath_parts[rel_filepath_parts[3].notna()]
+    if rel_filepath_parts.empty:
+        return pd.DataFrame(columns=[
+            'POISONED_BAMBOO_HOME_PATH', 'KEY_ID', 'BUILD_JOB', 'DEPLOYMENT', 'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS',
+            'FOUND_ON_AGENT_HOSTS',
+        ])
+    job_or_deployment_keys = rel_filepath_parts[2]
+    key_dashes = job_or_deployment_keys.str.count('-')
+    log_file_df = pd.DataFrame({
+        'POISONED_BAMBOO_HOME_PATH': ('$BAMBOO_HOME/' + rel_filepath_parts[0] + '/' + rel_filepath_parts[1]
+                                      + '/' + job_or_deployment_keys),
+        'KEY_ID': job_or_deployment_keys,
+        'BUILD_JOB': job_or_deployment_keys.where(key_dashes == 2),
+        'DEPLOYMENT': job_or_deployment_keys.where(key_dashes == 1),
+        'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS': rel_filepath_parts[3],
+    })
+    invalid_keys = log_file_df.loc[log_file_df['BUILD_JOB'].isna() & log_file_df['DEPLOYMENT'].isna(), 'KEY_ID']
+    assert invalid_keys.empty, f"Invalid build job or deployment '{invalid_keys.iloc[0]}'!"
+    log_file_df['FOUND_ON_AGENT_HOSTS'] = hostname_short
+    # if debug:
+    #     click.echo(f"Log file '{log_file_path}' parsed to DataFrame:")
+    #     click.echo(log_file_df)
+    return log_file_df
 
 
 @click.group()
@@ -79,8 +143,8 @@ def cli(ctx: any, debug: bool, tmp_dir: str, todays_date=None, max_content_width
     2. ./root_poisoning.py --tmp-dir=/tmp/ci-health 2-parse-todays-logs
     1. ./root_poisoning.py --tmp-dir=/tmp/ci-health 3-generate-todays-reports --output-dir=/usr/share/nginx/html/static/root-poisoned
     """
-    os.makedirs(tmp_dir, exist_ok=True)
-    todays_date = todays_date if todays_date else sh.date('+%y%m%d').strip()
+    _ensure_dir(tmp_dir)
+    todays_date = todays_date if todays_date else datetime.date.today().strftime('%y%m%d')
     if debug:
         click.echo(f"Debug mode is on")
         click.echo(f"Temporary reports/data directory is {tmp_dir}")
@@ -112,26 +176,44 @@ def retrieve_todays_logs(ctx, bamboo_agent_ssh_user: str, bamboo_agent_ssh_key:
     copied_private_key_path = f"{tmp_base_dir}/bamboo-agent-ssh-key"
     if ctx.obj['DEBUG']:
         click.echo(f"Copy '{bamboo_agent_ssh_key}' to '{copied_private_key_path}' and corrected ownership:")
-    sh.cp('-v', bamboo_agent_ssh_key, copied_private_key_path)
-    sh.chmod('0600', copied_private_key_path)
+    # Create the copy with owner-only permissions before writing the key to it, so that it's never readable by others
+    key_fd = os.open(copied_private_key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(key_fd, 0o600)  # In case a copy was left behind by an aborted run
+    with open(bamboo_agent_ssh_key, 'rb') as src, os.fdopen(key_fd, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
     if ctx.obj['DEBUG']:
-        sh.ls('-lFah', copied_private_key_path, _out=sys.stdout).strip('\n')
+        click.echo(f"{stat.filemode(os.stat(copied_private_key_path).st_mode)} {copied_private_key_path}")
 
-    for hostname in bamboo_agent_hostnames:
+    def _scp_one(hostname: str) -> bool:
+        """Retrieve the daily log file from a single agent, return whether it succeeded."""
         local_log_filename = f"{tmp_base_dir}/todays_{hostname}_bamboo-home-assets-chowned.log"
         if ctx.obj['DEBUG']:
             click.echo(
                 f"Retrieving daily log file from '{hostname}' to '{local_log_filename}' as '{bamboo_agent_ssh_user}'..."
             )
-        sh.scp("-i", copied_private_key_path, "-o", "StrictHostKeyChecking=no",
-               f"{bamboo_agent_ssh_user}@{hostname}:{remote_log_filename}", local_log_filename)
+        try:
+            sh.scp("-i", copied_private_key_path, "-o", "StrictHostKeyChecking=no",
+                   f"{bamboo_agent_ssh_user}@{hostname}:{remote_log_filename}", local_log_filename)
+            return True
+        except sh.ErrorReturnCode as e:
+            click.echo(f"WARN: Failed to retrieve daily log file from '{hostname}': {e.stderr.decode().strip()}")
+            return False
+
+    # Retrieve from all agents concurrently, a failing agent doesn't abort the others
+    with ThreadPoolExecutor(max_workers=min(32, len(bamboo_agent_hostnames))) as executor:
+        retrieved = list(executor.map(_scp_one, bamboo_agent_hostnames))
+    if not all(retrieved):
+        click.echo(f"WARN: Daily log files not retrieved from {retrieved.count(False)} of "
+                   f"{len(bamboo_agent_hostnames)} agents!")
 
     if ctx.obj['DEBUG']:
         click.echo(f"Fry the private SSH key '{copied_private_key_path}'...")
-    sh.rm('-f', copied_private_key_path)
+    os.remove(copied_private_key_path)
 
     click.echo(f"Today's log files retrieved from agents and stored to '{tmp_base_dir}':")
-    sh.ls('-lFah', _cwd=tmp_base_dir, _out=sys.stdout).strip('\n')
+    with os.scandir(tmp_base_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            click.echo(f"{entry.stat().st_size:>12} {entry.name}")
 
 
 @cli.command('2-parse-todays-logs')
@@ -139,57 +221,24 @@ def retrieve_todays_logs(ctx, bamboo_agent_ssh_user: str, bamboo_agent_ssh_key:
 def parse_todays_logs(ctx):
     """Parse today's logs in `--tmp-dir`/%y%m%d_root-poisoning/."""
 
-    def _parse_log_file(log_file_path: str, debug=False) -> pd.DataFrame:
-        """Parse a log file and return a DataFrame with the data in separate columns."""
-        hostname_short = log_file_path.split('/')[-1].split('_')[1].split('.smithmicro.net')[0]
-        log_lines = []
-        with open(log_file_path, 'r') as f:
-            for line in f.readlines():
-                if 'changed ownership of ' in line and ' from root:root to bamboo:bamboo' in line:
-                    file_path_and_ownership = line.strip().split('changed ownership of ')[-1]
-                    filepath = file_path_and_ownership.split(' from root:root to bamboo:bamboo')[0].strip("'‘’")
-                    if filepath.startswith("/home/bamboo/bamboo-agent-home/xml-data/"):
-                        rel_filepath = filepath.split('/home/bamboo/bamboo-agent-home/')[-1]
-                        job_or_deployment_key = rel_filepath.split('/')[2]
-                        build_job = job_or_deployment_key if job_or_deployment_key.count('-') == 2 else pd.NA
-                        deployment = job_or_deployment_key if job_or_deployment_key.count('-') == 1 else pd.NA
-                        assert (
-                            isinstance(build_job, str) or isinstance(deployment, str)
-                        ), f"Invalid build job or deployment '{job_or_deployment_key}'!"
-                        tasks_local_path = rel_filepath.split('/', 3)[3]
-                        poisoned_bamboo_home_path = '$BAMBOO_HOME/' + '/'.join(rel_filepath.split('/')[:3])
-                        log_lines.append(
-                            [poisoned_bamboo_home_path, job_or_deployment_key, build_job, deployment, tasks_local_path]
-                        )
-                    else:
-                        click.echo(f"WARN: Ignored non-build plan file '{filepath}' on {hostname_short}!")
-        log_file_df = pd.DataFrame(log_lines, columns=[
-            'POISONED_BAMBOO_HOME_PATH', 'KEY_ID', 'BUILD_JOB', 'DEPLOYMENT', 'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS'
-        ])
-        log_file_df['FOUND_ON_AGENT_HOSTS'] = hostname_short
-        # if debug:
-        #     click.echo(f"Log file '{log_file_path}' parsed to DataFrame:")
-        #     click.echo(log_file_df)
-        return log_file_df
-
     # Get log files in today's temp dir
     todays_temp_dir = _get_todays_temp_dir(ctx.obj['TMP_DIR'], ctx.obj['TODAYS_DATE'])
-    if not os.path.isdir(todays_temp_dir):
-        click.echo(f"Today's temp directory '{todays_temp_dir}' not found, did you run `./root_poisoning.py "
-                   f"1-retrieve-todays-logs <agent_ssh_user> <agent_ssh_key> <bamboo_agent_hostnames...>`?")
+    log_files = sorted(glob.glob(f"{todays_temp_dir}/*_bamboo-home-assets-chowned.log"))
+    if not log_files:
+        click.echo(f"No log files found in today's temp directory '{todays_temp_dir}', did you run "
+                   f"`./root_poisoning.py 1-retrieve-todays-logs <agent_ssh_user> <agent_ssh_key> "
+                   f"<bamboo_agent_hostnames...>`?")
         exit(1)
-    log_files = sh.find(todays_temp_dir, '-name', '*_bamboo-home-assets-chowned.log').split()
     click.echo(f"Found {len(log_files)} log files to parse in '{todays_temp_dir}'...")
 
-    # Parse each log file into a DataFrame
-    log_file_dataframes = []
-    for log_file in log_files:
-        log_file_dataframes.append(_parse_log_file(log_file, ctx.obj['DEBUG']))
+    # Parse each log file into a DataFrame, one worker process per CPU
+    with ProcessPoolExecutor() as executor:
+        log_file_dataframes = list(executor.map(_parse_log_file, log_files, itertools.repeat(ctx.obj['DEBUG'])))
 
     # Concatenate all logs into a single DataFrame
     all_log_files_df = pd.concat(log_file_dataframes, ignore_index=True)
-    dump_path = f"{todays_temp_dir}/todays_bamboo-home-assets-chowned.pkl"
-    all_log_files_df.to_pickle(dump_path)
+    dump_path = f"{todays_temp_dir}/todays_bamboo-home-assets-chowned.arrow"
+    dump_df(all_log_files_df, dump_path)
     if ctx.obj['DEBUG']:
         click.echo(f"Full root-poisoning logs DataFrame for today:")
         click.echo(all_log_files_df)
@@ -207,7 +256,7 @@ def generate_todays_reports(ctx, output_dir: str):
 
     todays_date = ctx.obj['TODAYS_DATE']
     todays_temp_dir = _get_todays_temp_dir(ctx.obj['TMP_DIR'], todays_date)
-    dump_path = f"{todays_temp_dir}/todays_bamboo-home-assets-chowned.pkl"
+    dump_path = f"{todays_temp_dir}/todays_bamboo-home-assets-chowned.arrow"
     if not os.path.isfile(dump_path):
         click.echo(
             f"Root-poisoning logs not found at {dump_path}, did you run `./root_poisoning.py 2-parse-todays-logs`?"
@@ -218,11 +267,10 @@ def generate_todays_reports(ctx, output_dir: str):
     reports_archive_dir = f"{output_dir}/archive"
     os.makedirs(reports_archive_dir, mode=0o775, exist_ok=True)
     if ctx.obj['DEBUG']:
-        click.echo(f"Writing reports to `--output-dir` '{output_dir}' (archive dir '{reports_archive_dir}')`:")
-        click.echo(sh.ls('-lFah', output_dir, reports_archive_dir).strip('\n'))
+        click.echo(f"Writing reports to `--output-dir` '{output_dir}' (archive dir '{reports_archive_dir}')...")
 
     # Read raw report data
-    all_log_files_df = pd.read_pickle(dump_path)
+    all_log_files_df = load_df(dump_path)
 
     # Get unique build jobs and deployments
     unique_build_jobs = all_log_files_df['BUILD_JOB'].unique()
@@ -231,49 +279,50 @@ def generate_todays_reports(ctx, output_dir: str):
         click.echo(f"Found {len(unique_build_jobs)} unique build jobs and "
                    f"{len(unique_deployments)} unique deployments...")
 
-    def _summarize_hosts(hosts: pd.Series) -> str:
-        """Summarize the unique hosts for a build job or a deployment."""
-        unique_hosts = hosts.unique()
-        html_unique_hosts = list(map(lambda host: f"<code>{host}</code>", unique_hosts))
-        return ', '.join(html_unique_hosts)
-
-    def _summarize_local_paths(local_paths: pd.Series) -> str:
-        """Summarize the unique workspace-local root-poisoned file paths for a build job or a deployment."""
-        unique_paths = local_paths.unique()
-        max_paths = 100
-        html_unique_paths = list(map(lambda path: f"<code>{path}</code>", unique_paths))
-        if len(html_unique_paths) > max_paths:
-            return f"{', '.join(html_unique_paths[:max_paths])}... ({len(html_unique_paths) - max_paths} more)"
-        return ', '.join(html_unique_paths)
+    # Summarize the unique hosts and the unique workspace-local root-poisoned file paths, in one pass over all rows
+    max_paths = 100
+    unique_hosts = all_log_files_df[['KEY_ID', 'FOUND_ON_AGENT_HOSTS']].drop_duplicates()
+    hosts_per_key = ('<code>' + unique_hosts['FOUND_ON_AGENT_HOSTS'] + '</code>').groupby(
+        unique_hosts['KEY_ID']).agg(', '.join)
+    unique_paths = all_log_files_df[['KEY_ID', 'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS']].drop_duplicates()
+    unique_paths_by_key = unique_paths.groupby('KEY_ID')
+    html_unique_paths = '<code>' + unique_paths['LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS'] + '</code>'
+    paths_per_key = html_unique_paths[unique_paths_by_key.cumcount() < max_paths].groupby(
+        unique_paths['KEY_ID']).agg(', '.join)
+    more_paths_per_key = unique_paths_by_key.size() - max_paths
+    paths_per_key = paths_per_key.where(more_paths_per_key <= 0,
+                                        paths_per_key + '... (' + more_paths_per_key.astype(str) + ' more)')
 
     # Group by build job and deployment
     grouped_by_build_job_and_deployment = all_log_files_df.groupby('KEY_ID').agg({
         'POISONED_BAMBOO_HOME_PATH': 'first',
         'BUILD_JOB': 'first',
         'DEPLOYMENT': 'first',
-        'FOUND_ON_AGENT_HOSTS': _summarize_hosts,
-        'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS': _summarize_local_paths
     })
+    grouped_by_build_job_and_deployment['FOUND_ON_AGENT_HOSTS'] = hosts_per_key
+    grouped_by_build_job_and_deployment['LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS'] = paths_per_key
 
     # Prepare DataFrame for report
     if ctx.obj['DEBUG']:
         click.echo(f"Hosts and local file paths grouped by build job and deployment:")
         click.echo(grouped_by_build_job_and_deployment)
 
-    grouped_by_build_job_and_deployment['BUILD_JOB_LINK'] = grouped_by_build_job_and_deployment['BUILD_JOB'].apply(
-        lambda build_job: (f'<a href="/browse/{build_job}/latest" target="_blank"><pre>{build_job}</pre></a>'
-                           if build_job else '')
-    )
+    build_jobs = grouped_by_build_job_and_deployment['BUILD_JOB']
+    grouped_by_build_job_and_deployment['BUILD_JOB_LINK'] = (
+        '<a href="/browse/' + build_jobs + '/latest" target="_blank"><pre>' + build_jobs + '</pre></a>'
+    ).where(build_jobs.notna(), '')
 
-    grouped_by_build_job_and_deployment['DEPLOYMENT_LINK'] = grouped_by_build_job_and_deployment['DEPLOYMENT'].apply(
-        lambda deployment: (f'<a href="/deploy/viewEnvironment.action?id={deployment.split("-")[1]}" '
-                            f'target="_blank"><pre>{deployment}</pre></a>') if deployment else ''
-    )
+    deployments = grouped_by_build_job_and_deployment['DEPLOYMENT']
+    grouped_by_build_job_and_deployment['DEPLOYMENT_LINK'] = (
+        '<a href="/deploy/viewEnvironment.action?id=' + deployments.str.split('-').str[1] + '" '
+        'target="_blank"><pre>' + deployments + '</pre></a>'
+    ).where(deployments.notna(), '')
 
-    grouped_by_build_job_and_deployment['POISONED_BAMBOO_HOME_PATH'] = grouped_by_build_job_and_deployment[
-        'POISONED_BAMBOO_HOME_PATH'].apply(lambda home_path: f"<pre>{home_path}/</pre>")
+    grouped_by_build_job_and_deployment['POISONED_BAMBOO_HOME_PATH'] = (
+        '<pre>' + grouped_by_build_job_and_deployment['POISONED_BAMBOO_HOME_PATH'] + '/</pre>'
+    )
 
-    # Update DataFrame with columns for report and write to HTML and pickle files
+    # Update DataFrame with columns for report and write to HTML and Parquet files
     df_columns_for_report = grouped_by_build_job_and_deployment[[
         'BUILD_JOB_LINK', 'DEPLOYMENT_LINK', 'POISONED_BAMBOO_HOME_PATH', 'LOCAL_PATH_FOR_BUILD_OR_DEPLOYMENT_TASKS',
         'FOUND_ON_AGENT_HOSTS'
@@ -286,10 +335,10 @@ def generate_todays_reports(ctx, output_dir: str):
     archive_file = (f"{reports_archive_dir}/"
                     f"{archive_date.strftime('%y%m%dT%HZ')}_root_poisoned_build_jobs_and_deployments_{todays_date}")
 
-    click.echo(f"Writing report to '{output_dir}/index.html', '{archive_file}.html', and '{archive_file}.pkl'")
-    df_columns_for_report.to_html(f"{archive_file}.html", escape=False, index=False)
-    df_columns_for_report.to_pickle(f"{archive_file}.pkl")
-    df_columns_for_report.to_html(f"{output_dir}/index.html", escape=False, index=False)
+    click.echo(f"Writing report to '{output_dir}/index.html', '{archive_file}.html[.gz]', and "
+               f"'{archive_file}.parquet'")
+    df_columns_for_report.to_parquet(f"{archive_file}.parquet", engine='pyarrow', compression='snappy')
+    write_html_report(render_html_table(df_columns_for_report), f"{archive_file}.html", f"{output_dir}/index.html")
 
 
 if __name__ == '__main__':